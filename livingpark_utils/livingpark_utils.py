@@ -1,26 +1,115 @@
 """Provide utility function for the LivingPark notebook for paper replication."""
 import datetime
+import fnmatch
+import functools
 import glob
-import math
+import hashlib
+import logging
+import multiprocessing
 import os.path
 import pkgutil
+import re
 import subprocess
 import sys
 import warnings
-from pprint import pprint
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
 
-import nilearn.plotting as nplt
 import numpy as np
+import numpy.typing as npt
 import pandas as pd
-import ppmi_downloader
 import pytz  # type: ignore
-from boutiques.descriptor2func import function as descriptor2func
-from dateutil.parser import parse  # type: ignore
-from dateutil.relativedelta import relativedelta  # type: ignore
 from IPython.display import HTML
 from IPython.display import Image as ImageDisplay
-from matplotlib import pyplot as plt
-from PIL import Image
+
+# Heavy dependencies (nilearn, ppmi_downloader, boutiques, matplotlib, PIL) are
+# imported by the functions using them, to keep the import of this module fast.
+if TYPE_CHECKING:
+    import ppmi_downloader
+
+_logger = logging.getLogger(__name__)
+
+_TOGGLE_BUTTON_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "toggle_button.html"
+)
+
+# Characters replaced by underscores in PPMI file names
+_PROTOCOL_TRANS = str.maketrans({" ": "_", "(": "_", ")": "_", "/": "_"})
+
+
+@functools.lru_cache(maxsize=512)
+def _clean_protocol_description(desc: str) -> str:
+    return desc.translate(_PROTOCOL_TRANS)
+
+
+def _symlink_if_missing(src: str, dst: str) -> None:
+    try:
+        os.symlink(src, dst)
+    except FileExistsError:
+        pass
+
+
+# Descriptors are downloaded and parsed once per session
+@functools.lru_cache(maxsize=16)
+def _descriptor_function(descriptor: str):
+    from boutiques.descriptor2func import function as descriptor2func
+
+    return descriptor2func(descriptor)
+
+
+def _use_agg_backend() -> None:
+    from matplotlib import pyplot as plt
+
+    plt.switch_backend("Agg")  # worker processes have no display
+
+
+def _plot_segmentation(job: tuple) -> None:
+    import nilearn.plotting as nplt
+    from matplotlib import pyplot as plt
+
+    title, output_file_c1, output_file_c2, cut_coords, alpha, folder, file_name = job
+
+    fig = plt.figure()
+    display = nplt.plot_anat(cut_coords=list(cut_coords), figure=fig, title=title)
+    display.add_overlay(output_file_c1, cmap="Reds", threshold=0.1, alpha=alpha)
+    display.add_overlay(output_file_c2, cmap="Blues", threshold=0.1, alpha=alpha)
+
+    plt.savefig(os.path.join(folder, file_name))
+    plt.close(fig)  # so as to not display the figure
+
+
+def _parse_dates(dates: pd.Series, name: str) -> pd.Series:
+    parsed = pd.to_datetime(dates, format="%m/%Y", errors="coerce")
+    failed = parsed.isna() & dates.notna()
+    if failed.any():
+        # Fall back to lenient parsing, only for dates in other formats
+        parsed[failed] = pd.to_datetime(dates[failed], format="mixed", errors="coerce")
+        n_failed = int((parsed.isna() & dates.notna()).sum())
+        if n_failed > 0:
+            print(f"Warning: {n_failed} {name} dates could not be parsed")
+    return parsed
+
+
+# Smallest number of segmentation images rendered in a process pool
+_MIN_PARALLEL_PLOTS = 8
+
+# Subjects per imaging download, and attempts made for each batch
+_DOWNLOAD_BATCH_SIZE = 50
+_DOWNLOAD_ATTEMPTS = 3
+
+
+# MMSE score indexed by MoCA score, from Table 2 in
+# https://www.ncbi.nlm.nih.gov/pmc/articles/PMC4371590
+# fmt: off
+_MOCA_TO_MMSE = np.array(
+    [
+        np.nan, 6, 9, 11, 12, 13, 14, 15, 15, 16, 17, 18, 18, 19, 20, 21, 22, 22,
+        23, 24, 25, 26, 26, 27, 28, 28, 29, 29, 30, 30, 30,
+    ],
+    dtype=np.float32,
+)
+# fmt: on
 
 
 class LivingParkUtils:
@@ -40,6 +129,8 @@ class LivingParkUtils:
         """
         self.data_cache_path = data_cache_path
         self.study_files_dir = os.path.abspath(os.path.join("inputs", "study_files"))
+        # Downloader shared by all downloads, created on first use
+        self._ppmi_dl: "ppmi_downloader.PPMIDownloader | None" = None
 
         self.setup_notebook_cache()
         os.makedirs(self.study_files_dir, exist_ok=True)
@@ -56,14 +147,12 @@ class LivingParkUtils:
 
         # Make or update links to cache
         for x in ["inputs", "outputs"]:
-            if os.path.islink(x):
-                print(f"removing link {x}")
-                os.remove(x)
-            elif os.path.exists(x):
+            if os.path.exists(x) and not os.path.islink(x):
                 raise Exception(f"Directory {x} exists and is not a symlink.")
-            else:
-                print(f"{x} doesnt exist")
-            os.symlink(os.path.join(self.data_cache_path, x), x)
+            # Replace the link atomically, so that x never goes missing
+            tmp_link = f"{x}.tmp-{os.urandom(4).hex()}"
+            os.symlink(os.path.join(self.data_cache_path, x), tmp_link)
+            os.replace(tmp_link, x)
 
     def notebook_init(self) -> HTML:
         """Initialize a paper replication notebook.
@@ -78,23 +167,45 @@ class LivingParkUtils:
         """
         warnings.filterwarnings("ignore")
 
-        print("Installing notebook dependencies (see log in install.log)... ")
-        f = open("install.log", "wb")
-        subprocess.check_call(
-            [sys.executable, "-m", "pip", "install", "-r", "requirements.txt"],
-            stdout=f,
-            stderr=f,
-        )
+        # Skip pip when requirements.txt is unchanged since the last install in this
+        # Python environment, the cache may be shared by several environments
+        requirements_hash = hashlib.sha256(sys.prefix.encode() + b"\0")
+        with open("requirements.txt", "rb") as f:
+            requirements_hash.update(f.read())
+        stamp_file = os.path.join(self.data_cache_path, "requirements.sha256")
+        try:
+            with open(stamp_file) as f:
+                installed_hash = f.read().strip()
+        except FileNotFoundError:
+            installed_hash = None
+
+        if installed_hash == requirements_hash.hexdigest():
+            print("Notebook dependencies up to date.")
+        else:
+            print("Installing notebook dependencies (see log in install.log)... ")
+            with open("install.log", "wb") as f:
+                subprocess.check_call(
+                    [
+                        sys.executable,
+                        "-m",
+                        "pip",
+                        "install",
+                        "--quiet",
+                        "--no-input",
+                        "--disable-pip-version-check",
+                        "-r",
+                        "requirements.txt",
+                    ],
+                    stdout=f,
+                    stderr=f,
+                )
+            with open(stamp_file, "w") as f:
+                f.write(requirements_hash.hexdigest())
 
         now = datetime.datetime.now(pytz.utc).strftime("%Y-%m-%d %H:%M:%S %Z %z")
         print(f"This notebook was run on {now}")
 
-        return HTML(
-            filename=os.path.join(
-                os.path.dirname(os.path.abspath(__file__)),
-                "toggle_button.html",
-            )
-        )
+        return HTML(filename=_TOGGLE_BUTTON_FILE)
 
     def download_ppmi_metadata(
         self,
@@ -123,17 +234,27 @@ class LivingParkUtils:
         if force:
             missing_files = required_files
         else:
-            missing_files = [
+            # Files are checked on disk at each call, since they may be deleted
+            found: set[str] = set()
+            try:
+                with os.scandir(self.study_files_dir) as it:
+                    found.update(x.name for x in it)
+            except FileNotFoundError:
+                pass
+            # Files in sub-directories are not listed by scandir
+            found.update(
                 x
                 for x in required_files
-                if not os.path.exists(os.path.join(self.study_files_dir, x))
-            ]
+                if os.path.dirname(x)
+                and os.path.exists(os.path.join(self.study_files_dir, x))
+            )
+            missing_files = [x for x in required_files if x not in found]
 
         if len(missing_files) > 0:
-            pprint(f"Downloading files: {missing_files}")
+            print(f"Downloading {len(missing_files)} files")
+            _logger.debug("Downloading files: %s", missing_files)
             try:
-                ppmi = ppmi_downloader.PPMIDownloader()
-                ppmi.download_metadata(
+                self._get_ppmi_downloader().download_metadata(
                     missing_files,
                     destination_dir=self.study_files_dir,
                     headless=headless,
@@ -141,6 +262,7 @@ class LivingParkUtils:
                 )
             except Exception as e:
                 print("Download failed!")
+                self._ppmi_dl = None
                 raise (e)
 
             print("Download completed!")
@@ -148,6 +270,18 @@ class LivingParkUtils:
         else:
             print("Download skipped: No missing files!")
 
+    def _get_ppmi_downloader(self) -> "ppmi_downloader.PPMIDownloader":
+        """Return the PPMI downloader of this notebook, creating it if needed.
+
+        The downloader is reused across downloads, and is reset after a failed
+        download so that the next one starts from a new instance.
+        """
+        if self._ppmi_dl is None:
+            import ppmi_downloader
+
+            self._ppmi_dl = ppmi_downloader.PPMIDownloader()
+        return self._ppmi_dl
+
     # def __install_datalad_cache(self) -> None:
     #     """Install the DataLad dataset.
 
@@ -177,9 +311,7 @@ class LivingParkUtils:
         str
             Protocol description. Example: "MPRAGE GRAPPA"
         """
-        return (
-            desc.replace(" ", "_").replace("(", "_").replace(")", "_").replace("/", "_")
-        )
+        return _clean_protocol_description(desc)
 
     def find_nifti_file_in_cache(
         self,
@@ -187,6 +319,7 @@ class LivingParkUtils:
         event_id: str,
         protocol_description: str,
         base_dir: str = "inputs",
+        index: dict[tuple[str, str], list[str]] | None = None,
     ) -> str | None:
         """Return cached nifti files, if any.
 
@@ -194,6 +327,7 @@ class LivingParkUtils:
         `protocol_description` in the cache directory.
         If not found, search for nifti file matching `subject_id` and `event_id` only,
         and return it if a single file is found.
+        If `index` is given, files are looked up in it instead of listing the cache.
 
         Parameters
         ----------
@@ -205,6 +339,9 @@ class LivingParkUtils:
             Protocol description. Example: "MPRAGE GRAPPA"
         base_dir: str, default "inputs"
             TODO Describe this. Not sure what it is exactly.
+        index: dict, optional
+            Index of the cache built by `build_nifti_cache_index`. Useful when
+            looking up many subjects.
 
         Returns
         -------
@@ -212,15 +349,33 @@ class LivingParkUtils:
             File name matching the `subject_id`, `event_id`, and if possible
             `protocol_description`. None if no matching file is found.
         """
-        expression = os.path.join(
+        anat_dir = os.path.join(
             self.data_cache_path,
             base_dir,
             f"sub-{subject_id}",
             f"ses-{event_id}",
             "anat",
-            f"PPMI_*{self.clean_protocol_description(protocol_description)}*.nii",
         )
-        files = glob.glob(expression)
+        if index is None:
+            # A single listing of the directory serves both patterns
+            try:
+                with os.scandir(anat_dir) as it:
+                    candidates = [entry.path for entry in it]
+            except FileNotFoundError:
+                return None
+        else:
+            candidates = index.get((str(subject_id), str(event_id)), [])
+
+        def match(pattern):
+            return [
+                x for x in candidates if fnmatch.fnmatch(os.path.basename(x), pattern)
+            ]
+
+        # Descriptions may contain glob special characters such as '[' or '*'
+        description = glob.escape(self.clean_protocol_description(protocol_description))
+        pattern = f"PPMI_*{description}*.nii"
+        expression = os.path.join(anat_dir, pattern)
+        files = match(pattern)
         assert len(files) <= 1, f"More than 1 Nifti file matched by {expression}"
         if len(files) == 1:
             return files[0]
@@ -229,15 +384,9 @@ class LivingParkUtils:
         #     f"{(subject_id, event_id, protocol_description)} with strict glob "
         #     "expression. Trying with lenient glob expression."
         # )
-        expression = os.path.join(
-            self.data_cache_path,
-            base_dir,
-            f"sub-{subject_id}",
-            f"ses-{event_id}",
-            "anat",
-            "PPMI_*.nii",
-        )
-        files = glob.glob(expression)
+        pattern = "PPMI_*.nii"
+        expression = os.path.join(anat_dir, pattern)
+        files = match(pattern)
         assert len(files) <= 1, f"More than 1 Nifti file matched by {expression}"
         if len(files) == 1:
             return files[0]
@@ -248,37 +397,101 @@ class LivingParkUtils:
         # )
         return None
 
+    def build_nifti_cache_index(
+        self, base_dir: str = "inputs"
+    ) -> dict[tuple[str, str], list[str]]:
+        """Index cached nifti files by subject and event.
+
+        Walk the cache once so that `find_nifti_file_in_cache` can look up a whole
+        cohort without globbing the cache for every subject.
+
+        Parameters
+        ----------
+        base_dir: str, default "inputs"
+            Directory of the cache to index.
+
+        Returns
+        -------
+        dict
+            Maps (subject ID, event ID) to the list of nifti files found in
+            sub-{subject ID}/ses-{event ID}/anat.
+        """
+
+        def scan(path, prefix, suffix="", is_dir=True):
+            try:
+                with os.scandir(path) as it:
+                    return [
+                        x
+                        for x in it
+                        if x.name.startswith(prefix)
+                        and x.name.endswith(suffix)
+                        and x.is_dir() == is_dir
+                    ]
+            except (FileNotFoundError, NotADirectoryError):
+                return []
+
+        index: dict[tuple[str, str], list[str]] = {}
+        for sub in scan(os.path.join(self.data_cache_path, base_dir), "sub-"):
+            for ses in scan(sub.path, "ses-"):
+                files = scan(os.path.join(ses.path, "anat"), "PPMI_", ".nii", False)
+                if files:
+                    key = (sub.name.removeprefix("sub-"), ses.name.removeprefix("ses-"))
+                    index[key] = [x.path for x in files]
+        return index
+
     def disease_duration(self) -> pd.DataFrame:
         """Return a DataFrame containing disease durations.
 
+        Dates are expected in the "%m/%Y" format of PPMI study files. Dates in other
+        formats are parsed leniently, and a warning is printed for the dates that
+        cannot be parsed, which give NaN durations.
+
         Returns
         -------
         pd.DataFrame
             DataFrame containing disease durations for each (patient,event) pair found
-            in "MDS_UPDRS_Part_III.csv".
+            in "MDS_UPDRS_Part_III.csv". PATNO and EVENT_ID columns are backed by
+            pyarrow (int64[pyarrow] and string[pyarrow]).
         """
         # Download required files
         self.download_ppmi_metadata(
             ["MDS_UPDRS_Part_III.csv", "PD_Diagnosis_History.csv"]
         )
 
+        # Only parse the needed columns
         pddxdt = pd.read_csv(
-            os.path.join(self.study_files_dir, "PD_Diagnosis_History.csv")
-        )[["PATNO", "EVENT_ID", "PDDXDT"]]
-        pddxdt = pddxdt[(pddxdt["EVENT_ID"] == "SC") & pddxdt["PDDXDT"].notna()]
+            os.path.join(self.study_files_dir, "PD_Diagnosis_History.csv"),
+            usecols=["PATNO", "EVENT_ID", "PDDXDT"],
+            engine="pyarrow",
+            dtype_backend="pyarrow",
+        )
+        screening = pddxdt["EVENT_ID"].eq("SC").to_numpy(dtype=bool, na_value=False)
+        pddxdt = pddxdt.loc[
+            screening & pddxdt["PDDXDT"].notna().to_numpy(), ["PATNO", "PDDXDT"]
+        ]
         pdxdur = pd.read_csv(
             os.path.join(self.study_files_dir, "MDS_UPDRS_Part_III.csv"),
-            low_memory=False,
-        )[["PATNO", "EVENT_ID", "INFODT"]]
+            usecols=["PATNO", "EVENT_ID", "INFODT"],
+            engine="pyarrow",
+            dtype_backend="pyarrow",
+        )
 
-        PDDXDT_map = dict(zip(pddxdt["PATNO"].values, pddxdt["PDDXDT"].values))
+        # Mapping with an indexed Series uses pandas' hash table join. The last
+        # screening row of a patient is kept, as with the former dict mapping.
+        pddxdt = pddxdt.drop_duplicates("PATNO", keep="last")
+        PDDXDT_map = _parse_dates(pddxdt.set_index("PATNO")["PDDXDT"], "PDDXDT")
         pdxdur["PDDXDT"] = pdxdur["PATNO"].map(PDDXDT_map)
 
-        pdxdur["PDXDUR"] = pdxdur.apply(
-            lambda row: relativedelta(parse(row["INFODT"]), parse(row["PDDXDT"])).months
-            if row["PDDXDT"] is not np.nan
-            else np.nan,
-            axis=1,
+        # Month difference computed on whole columns rather than row by row
+        infodt = _parse_dates(pdxdur["INFODT"], "INFODT")
+        pddxdt_s = pdxdur["PDDXDT"]
+        pdxdur["PDXDUR"] = (
+            (
+                (infodt.dt.year - pddxdt_s.dt.year) * 12
+                + (infodt.dt.month - pddxdt_s.dt.month)
+            )
+            .abs()
+            .where(pddxdt_s.notna())
         )
         pdxdur.drop(labels=["INFODT", "PDDXDT"], inplace=True, axis=1)
 
@@ -300,47 +513,46 @@ class LivingParkUtils:
             https://www.ncbi.nlm.nih.gov/pmc/articles/PMC4371590
 
         """
-        mapping = {
-            1: 6,
-            2: 9,
-            3: 11,
-            4: 12,
-            5: 13,
-            6: 14,
-            7: 15,
-            8: 15,
-            9: 16,
-            10: 17,
-            11: 18,
-            12: 18,
-            13: 19,
-            14: 20,
-            15: 21,
-            16: 22,
-            17: 22,
-            18: 23,
-            19: 24,
-            20: 25,
-            21: 26,
-            22: 26,
-            23: 27,
-            24: 28,
-            25: 28,
-            26: 29,
-            27: 29,
-            28: 30,
-            29: 30,
-            30: 30,
-        }
-
-        try:
-            if math.isnan(moca_score):
-                return np.nan
-            else:
-                return mapping[moca_score]
-        except Exception as e:
-            print(e)
+        if pd.isna(moca_score):
+            return np.nan
+        if moca_score not in range(1, len(_MOCA_TO_MMSE)):
             return moca_score
+        return int(_MOCA_TO_MMSE[int(moca_score)])
+
+    def moca2mmse_array(self, moca_scores: npt.ArrayLike) -> np.ndarray:
+        """Return MMSE scores given an array of MoCA scores.
+
+        Vectorized version of `moca2mmse`, converting a whole cohort at once.
+        Unlike `moca2mmse`, which returns invalid scores unchanged, MoCA scores
+        that are not integers between 1 and 30 give NaN MMSE scores.
+
+        Parameters
+        ----------
+        moca_scores: array-like
+            MoCA scores, for instance a cohort column. Arrays of any shape are
+            accepted. Missing values are allowed, and a warning is printed for
+            non-numeric or out-of-range values.
+
+        Returns
+        -------
+        np.ndarray
+            MMSE scores corresponding to the MoCA scores, with the same shape, NaN
+            for missing or invalid MoCA scores.
+        """
+        shape = np.shape(moca_scores)
+        # Series are 1-dimensional, other arrays are converted flattened
+        series = pd.Series(np.ravel(moca_scores) if len(shape) > 1 else moca_scores)
+        scores = pd.to_numeric(series, errors="coerce").to_numpy(
+            dtype=np.float64, na_value=np.nan
+        )
+        # NaN scores compare False, and are left out with the invalid ones
+        valid = (scores >= 1) & (scores < len(_MOCA_TO_MMSE)) & (scores % 1 == 0)
+        n_invalid = int((series.notna().to_numpy() & ~valid).sum())
+        if n_invalid > 0:
+            print(f"Warning: {n_invalid} invalid MoCA scores converted to NaN")
+        mmse_scores = np.full(scores.shape, np.nan, dtype=_MOCA_TO_MMSE.dtype)
+        mmse_scores[valid] = _MOCA_TO_MMSE[scores[valid].astype(np.int64)]
+        return mmse_scores.reshape(shape)
 
     def download_missing_nifti_files(
         self, cohort: pd.DataFrame, link_in_outputs=False
@@ -372,67 +584,93 @@ class LivingParkUtils:
         None
         """
         # Find nifti file names in cohort
-        cohort["File name"] = cohort.apply(
-            lambda x: self.find_nifti_file_in_cache(
-                x["PATNO"], x["EVENT_ID"], x["Description"]
-            ),
-            axis=1,
-        )
-        print(
-            f"Number of available subjects: {len(cohort[cohort['File name'].notna()])}"
-        )
-        print(f"Number of missing subjects: {len(cohort[cohort['File name'].isna()])}")
+        index = self.build_nifti_cache_index()
+        cohort["File name"] = self._find_nifti_files(cohort, index)
+        # Rows still missing a file, until files are moved into the cache
+        missing = cohort["File name"].isna()
+        n_missing = int(missing.sum())
+        print(f"Number of available subjects: {len(cohort) - n_missing}")
+        print(f"Number of missing subjects: {n_missing}")
+
+        # Download missing file names, in batches so that a failure does not
+        # lose the subjects downloaded before it
+        # A subject with several missing visits is downloaded once
+        missing_subject_ids = cohort.loc[missing, "PATNO"].drop_duplicates()
+        print(f"Downloading image data of {len(missing_subject_ids)} subjects")
+        for start in range(0, len(missing_subject_ids), _DOWNLOAD_BATCH_SIZE):
+            stop = start + _DOWNLOAD_BATCH_SIZE
+            batch = missing_subject_ids.iloc[start:stop]
+            for attempt in range(_DOWNLOAD_ATTEMPTS):
+                try:
+                    self._get_ppmi_downloader().download_imaging_data(
+                        batch,
+                        type="nifti",
+                        timeout=120 * len(batch),
+                        headless=False,
+                    )
+                    break
+                except Exception as e:
+                    self._ppmi_dl = None
+                    if attempt == _DOWNLOAD_ATTEMPTS - 1:
+                        print("Download failed!")
+                        raise (e)
+                    print(f"Download failed, retrying ({attempt + 1})")
 
-        # Download missing file names
-        try:
-            ppmi_dl = ppmi_downloader.PPMIDownloader()
-            missing_subject_ids = cohort[cohort["File name"].isna()]["PATNO"]
-            print(f"Downloading image data of {len(missing_subject_ids)} subjects")
-            ppmi_dl.download_imaging_data(
-                missing_subject_ids,
-                type="nifti",
-                timeout=120 * len(missing_subject_ids),
-                headless=False,
-            )
-        except Exception as e:
-            print("Download failed!")
-            raise (e)
+        import ppmi_downloader
 
         # Find cohort file names among downloaded files
         results_path = "outputs"
         ppmi_fd = ppmi_downloader.PPMINiftiFileFinder()
-        for _, row in cohort.iterrows():
-            if row["File name"] is None:
-                filename = ppmi_fd.find_nifti(
-                    row["PATNO"], row["EVENT_ID"], row["Description"]
-                )
-                if filename is None:
-                    print(
-                        "Not found: "
-                        + f"{row['PATNO'], row['EVENT_ID'], row['Description']}"
-                    )
-                else:  # copy file to dataset
-                    dest_dir = os.path.join(
-                        "inputs",
-                        f'sub-{row["PATNO"]}',
-                        f'ses-{row["EVENT_ID"]}',
-                        "anat",
-                    )
-                    os.makedirs(dest_dir, exist_ok=True)
-                    dest_file = os.path.join(dest_dir, os.path.basename(filename))
-                    os.rename(filename, dest_file)
-                    row["File name"] = dest_file
-
-        # Update file names in cohort
-        cohort["File name"] = cohort.apply(
-            lambda x: self.find_nifti_file_in_cache(
-                x["PATNO"], x["EVENT_ID"], x["Description"]
-            ),
-            axis=1,
+        # Each (PATNO, EVENT_ID, Description) triple is searched and moved once
+        keys = ["PATNO", "EVENT_ID", "Description"]
+        triples = list(
+            cohort.loc[missing, keys]
+            .drop_duplicates()
+            .itertuples(index=False, name=None)
         )
+        # Searches are independent and I/O bound, files are moved afterwards
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            filenames = list(executor.map(lambda x: ppmi_fd.find_nifti(*x), triples))
+        moved = {}
+        dest_files: dict[str, str] = {}
+        for (patno, event_id, description), filename in zip(triples, filenames):
+            if filename is None:
+                print(f"Not found: {patno, event_id, description}")
+                continue
+            if filename not in dest_files:  # copy file to dataset
+                dest_files[filename] = os.path.join(
+                    self.data_cache_path,
+                    "inputs",
+                    f"sub-{patno}",
+                    f"ses-{event_id}",
+                    "anat",
+                    os.path.basename(filename),
+                )
+                index.setdefault((str(patno), str(event_id)), []).append(
+                    dest_files[filename]
+                )
+            moved[(patno, event_id, description)] = dest_files[filename]
+        # Create each destination directory once, then move the files
+        for dest_dir in {os.path.dirname(x) for x in dest_files.values()}:
+            os.makedirs(dest_dir, exist_ok=True)
+        for filename, dest_file in dest_files.items():
+            os.rename(filename, dest_file)
+        cohort.loc[missing, "File name"] = [
+            moved.get(x)
+            for x in cohort.loc[missing, keys].itertuples(index=False, name=None)
+        ]
+
+        # Update file names in cohort, rows already found are kept. Without new
+        # files in the cache, remaining rows would not be found either.
+        if dest_files:
+            missing = cohort["File name"].isna()
+            cohort.loc[missing, "File name"] = self._find_nifti_files(
+                cohort[missing], index
+            )
 
         # Create symlinks to inputs if necessary
         if link_in_outputs:
+            links = {}
             for file_name in cohort["File name"].values:
                 dest_dir = os.path.dirname(file_name).replace(
                     os.path.join(self.data_cache_path, "inputs"),
@@ -442,13 +680,46 @@ class LivingParkUtils:
                     dest_dir,
                     os.path.basename(file_name.replace(self.data_cache_path, "")),
                 )
-                if not os.path.exists(dest_file):
-                    # print(dest_dir, file_name, dest_file)
-                    os.makedirs(dest_dir, exist_ok=True)
-                    os.symlink(
-                        os.path.relpath(os.path.abspath(file_name), start=dest_file),
-                        dest_file,
-                    )
+                links[dest_file] = os.path.relpath(
+                    os.path.abspath(file_name), start=dest_file
+                )
+            for dest_dir in {os.path.dirname(x) for x in links}:
+                os.makedirs(dest_dir, exist_ok=True)
+            # Links are independent, existing ones are left untouched
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                list(executor.map(_symlink_if_missing, links.values(), links))
+
+    def _find_nifti_files(
+        self, cohort: pd.DataFrame, index: dict[tuple[str, str], list[str]]
+    ) -> list[str | None]:
+        """Return the cached nifti file of each cohort row.
+
+        `find_nifti_file_in_cache` is called once per distinct
+        (PATNO, EVENT_ID, Description) triple, not once per row.
+
+        Parameters
+        ----------
+        cohort: pd.DataFrame
+            A Pandas DataFrame containing columns PATNO, EVENT_ID and Description.
+        index: dict
+            Index of the cache built by `build_nifti_cache_index`.
+
+        Returns
+        -------
+        list
+            File names aligned with the cohort rows, None where no file is found.
+        """
+        keys = ["PATNO", "EVENT_ID", "Description"]
+        # Group codes follow the order of first appearance, as drop_duplicates
+        # does, and keep rows with missing values (NaN never equals itself)
+        codes = cohort.groupby(keys, dropna=False, sort=False).ngroup().to_numpy()
+        found = [
+            self.find_nifti_file_in_cache(patno, event_id, desc, index=index)
+            for patno, event_id, desc in cohort[keys]
+            .drop_duplicates()
+            .itertuples(index=False, name=None)
+        ]
+        return [found[code] for code in codes]
 
     def cohort_id(self, cohort: pd.DataFrame) -> str:
         """Return a unique id for the cohort.
@@ -507,9 +778,15 @@ class LivingParkUtils:
         """
 
         def replace_keys(string, replace_keys):
-            for k in replace_keys:
-                string = string.replace(k, replace_keys[k])
-            return string
+            if not replace_keys:
+                return string
+            # All keys are replaced in a single pass, longest first when they overlap
+            pattern = re.compile(
+                "|".join(
+                    re.escape(k) for k in sorted(replace_keys, key=len, reverse=True)
+                )
+            )
+            return pattern.sub(lambda m: replace_keys[m.group(0)], string)
 
         # Read template file
         with open(template_job_filename) as f:
@@ -609,7 +886,7 @@ class LivingParkUtils:
                 )
 
         # Initialize Boutiques Python function for descriptor
-        spm_batch = descriptor2func(boutiques_descriptor)
+        spm_batch = _descriptor_function(boutiques_descriptor)
 
         output = spm_batch(
             "launch",
@@ -714,39 +991,53 @@ class LivingParkUtils:
 
         if os.path.exists(folder):  # force is True
             print(f"Folder {folder} already exists, removing its content")
-            for f in glob.glob(os.path.join(folder, "*")):
-                os.remove(f)
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if not entry.is_dir(follow_symlinks=False):
+                        os.unlink(entry.path)
 
         os.makedirs(folder, exist_ok=True)
 
-        for i in range(len(cohort)):
-
-            input_file = cohort["File name"].values[i]
-            subj_id = cohort["PATNO"].values[i]
-
-            output_file_name = input_file.replace(
-                os.path.join(self.data_cache_path, "inputs"),
-                os.path.join("outputs", "pre_processing"),
-            )
-            output_file_c1 = output_file_name.replace("PPMI", "smwc1PPMI")
-            output_file_c2 = output_file_name.replace("PPMI", "smwc2PPMI")
-
-            fig = plt.figure()
-            display = nplt.plot_anat(
-                cut_coords=list(cut_coords), figure=fig, title=f"#{i}/{len(cohort)}"
-            )
-            display.add_overlay(output_file_c1, cmap="Reds", threshold=0.1, alpha=alpha)
-            display.add_overlay(
-                output_file_c2, cmap="Blues", threshold=0.1, alpha=alpha
-            )
+        output_file_names = cohort["File name"].str.replace(
+            os.path.join(self.data_cache_path, "inputs"),
+            os.path.join("outputs", "pre_processing"),
+            regex=False,
+        )
+        output_files_c1 = output_file_names.str.replace(
+            "PPMI", "smwc1PPMI", regex=False
+        )
+        output_files_c2 = output_file_names.str.replace(
+            "PPMI", "smwc2PPMI", regex=False
+        )
 
-            os.makedirs(folder, exist_ok=True)
-            plt.savefig(
-                os.path.join(
-                    folder, f"qc_{self.cohort_id(cohort)}_{subj_id}.{extension}"
+        cohort_id = self.cohort_id(cohort)
+        jobs = []
+        for i in range(len(cohort)):
+            jobs.append(
+                (
+                    f"#{i}/{len(cohort)}",
+                    output_files_c1.iat[i],
+                    output_files_c2.iat[i],
+                    cut_coords,
+                    alpha,
+                    folder,
+                    f"qc_{cohort_id}_{cohort['PATNO'].iat[i]}.{extension}",
                 )
             )
-            plt.close(fig)  # so as to not display the figure
+
+        # Subjects are rendered independently, in a process pool for cohorts large
+        # enough to pay for starting the workers
+        if len(jobs) < _MIN_PARALLEL_PLOTS:
+            for job in jobs:
+                _plot_segmentation(job)
+            return
+        with ProcessPoolExecutor(
+            max_workers=min(len(jobs), os.cpu_count() or 1),
+            initializer=_use_agg_backend,
+            # Forking a Jupyter kernel with live threads may deadlock the workers
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            list(executor.map(_plot_segmentation, jobs, chunksize=4))
 
     def make_gif(self, frame_folder: str, output_name: str = "animation.gif") -> None:
         """Make gifs from a set of images located in the same folder.
@@ -759,19 +1050,31 @@ class LivingParkUtils:
         output_name : str
             Base name of the gif file. Will be written in frame_folder.
         """
-        frames = [
-            Image.open(image)
-            for image in glob.glob(os.path.join(f"{frame_folder}", "*.png"))
-        ]
-        frame_one = frames[0]
-        frame_one.save(
-            os.path.join(frame_folder, output_name),
-            format="GIF",
-            append_images=frames,
-            save_all=True,
-            duration=1000,
-            loop=0,
-        )
+        from PIL import Image
+
+        paths = sorted(glob.glob(os.path.join(f"{frame_folder}", "*.png")))
+        opened = []
+
+        def open_frame(path):
+            frame = Image.open(path)
+            opened.append(frame)
+            return frame
+
+        # Frames are opened one at a time as the gif is written
+        try:
+            frame_one = open_frame(paths[0])
+            frame_one.save(
+                os.path.join(frame_folder, output_name),
+                format="GIF",
+                append_images=(open_frame(path) for path in paths[1:]),
+                save_all=True,
+                duration=1000,
+                loop=0,
+                optimize=True,
+            )
+        finally:
+            for frame in opened:
+                frame.close()
         print(f"Wrote {os.path.join(frame_folder, output_name)}")
 
     def qc_spm_segmentations(self, cohort) -> None:
@@ -11,7 +11,8 @@ install_requires = [
     "pillow",
     "matplotlib",
     "numpy",
-    "pandas",
+    "pandas>=2.1",
+    "pyarrow",
 ]
 
 setup(